@@ -3,59 +3,221 @@ import os
 import re
 import sys
 import argparse
+import io
+import mmap
 import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from PIL import Image
+from PIL import Image, PdfParser
 from multiprocessing import Pool, cpu_count
 
+YYYYMM_RE = re.compile(r'(\d{6})')
+
 
 def fast_find_dirs(root_path):
+    # Single iterative walk that only keeps directories holding at least one .jpg.
+    # The biggest issues come first so they are not left running alone at the end
     found_dirs = []
-    for entry in os.scandir(root_path):
-        if entry.is_dir():
-            found_dirs.append(entry.path)
-            found_dirs.extend(fast_find_dirs(entry.path))
-    return found_dirs
+    stack = [root_path]
+    while stack:
+        path = stack.pop()
+        jpg_count = 0
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.lower().endswith('.jpg'):
+                    jpg_count += 1
+        if jpg_count:
+            found_dirs.append((-jpg_count, path))
+    return [path for _, path in sorted(found_dirs)]
 
 
 def extract_yyyymm(foldername):
-    match = re.search(r'(\d{6})', os.path.basename(foldername))
+    match = YYYYMM_RE.search(os.path.basename(foldername))
     return match.group(1) if match else None
 
 
-def check_existing_pdf(folder, output_dir):
+def output_pdf_path(folder, output_dir):
     yyyymm = extract_yyyymm(folder)
     if not yyyymm:
+        return None
+    return os.path.join(output_dir, f"NGM_{yyyymm}.pdf")
+
+
+def check_existing_pdf(folder, output_dir):
+    # A stale .chk from an interrupted run is simply truncated by build_pdf
+    output_path = output_pdf_path(folder, output_dir)
+    if not output_path:
         return False, None
-    output_pdf = f"NGM_{yyyymm}.pdf"
-    output_path = os.path.join(output_dir, output_pdf)
-    temp_path = output_path + ".chk"
-    if os.path.exists(output_path):
-        return True, output_path
-    if os.path.exists(temp_path):
-        os.remove(temp_path)
-    return False, output_path
+    return os.path.exists(output_path), output_path
 
 
-def get_jpg_files(folder):
+def is_page(name, prefix):
+    # Matches NGM_YYYY_MM_###[A-Z]_#.jpg with plain string checks; prefix is NGM_YYYY_MM_
+    if not name.startswith(prefix):
+        return False
+    rest = name[len(prefix):-4]
+    if len(rest) == 6:
+        if not 'A' <= rest[3] <= 'Z':
+            return False
+    elif len(rest) != 5:
+        return False
+    # ASCII digits only: str.isdigit() also accepts characters like '²' that int() rejects
+    number = rest[:3]
+    return number.isascii() and number.isdigit() and rest[-2] == '_' and '0' <= rest[-1] <= '9'
+
+
+def get_jpg_files(folder, yyyymm):
+    # Numbered pages first, then inserts, foldouts, maps and other extras
+    prefix = f"NGM_{yyyymm[:4]}_{yyyymm[4:]}_"
+
+    def sort_key(entry):
+        if is_page(entry.name, prefix):
+            # By page number, so 051 comes before 051B ('_' sorts after letters)
+            rest = entry.name[len(prefix):-4]
+            return 0, int(rest[:3]), rest[3:-2], entry.name
+        return 1, 0, '', entry.name
+
     try:
-        files = sorted(f for f in os.listdir(folder) if f.lower().endswith('.jpg'))
-        return [os.path.join(folder, f) for f in files]
-    except Exception:
+        with os.scandir(folder) as entries:
+            files = [e for e in entries if e.name.lower().endswith('.jpg') and e.is_file()]
+    except OSError:
         return []
+    files.sort(key=sort_key)
+    return [e.path for e in files]
+
+
+JPEG_COLORSPACES = {'L': 'DeviceGray', 'RGB': 'DeviceRGB', 'CMYK': 'DeviceCMYK'}
+
+
+class NotEmbeddable(Exception):
+    pass
+
+
+def map_file(file):
+    # Page the file in from the cache on demand instead of copying it into a bytes object
+    with open(file, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    # Each scan is read once front to back: ask for aggressive readahead and let
+    # the kernel drop the pages early, leaving the cache to the other workers
+    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+        data.madvise(mmap.MADV_SEQUENTIAL)
+    return data
+
+
+def read_jpeg(file):
+    data = map_file(file)
+    try:
+        with Image.open(data) as im:
+            if im.format != 'JPEG' or im.mode not in JPEG_COLORSPACES:
+                raise NotEmbeddable(f"cannot embed {file} ({im.format} {im.mode})")
+            size, mode, inverted = im.size, im.mode, 'adobe' in im.info
+    except Exception:
+        data.close()
+        raise
+    return size, mode, inverted, data
+
+
+def prefetch(func, items, threads):
+    # Run func over items at most `threads` items ahead of the consumer, in order
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) > threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def embed_jpegs(jpg_list, pdf_path, threads=1):
+    # Lay the pages out like Pillow's PDF driver does, but store the original
+    # JPEG data as DCTDecode streams instead of decoding and recompressing it.
+    # Only pages that are not plain 8-bit JPEGs get decoded and recompressed
+    with PdfParser.PdfParser(pdf_path, mode="w+b") as pdf:
+        pdf.start_writing()
+        pdf.write_header()
+        refs = []
+        for _ in jpg_list:
+            refs.append((pdf.next_object_id(0), pdf.next_object_id(0), pdf.next_object_id(0)))
+            pdf.pages.append(refs[-1][1])
+        pdf.write_catalog()
+
+        # The next files are read while the current page is being written
+        jpegs = prefetch(read_page, jpg_list, threads)
+        for (image_ref, page_ref, contents_ref), jpeg in zip(refs, jpegs):
+            (width, height), mode, inverted, data = jpeg
+            image = dict(
+                Type=PdfParser.PdfName("XObject"),
+                Subtype=PdfParser.PdfName("Image"),
+                Width=width,
+                Height=height,
+                Filter=PdfParser.PdfName("DCTDecode"),
+                BitsPerComponent=8,
+                ColorSpace=PdfParser.PdfName(JPEG_COLORSPACES[mode]),
+            )
+            if mode == 'CMYK' and inverted:
+                image['Decode'] = [1, 0, 1, 0, 1, 0, 1, 0]
+            with data:
+                pdf.write_obj(image_ref, stream=data, **image)
+            pdf.write_page(
+                page_ref,
+                Resources=PdfParser.PdfDict(XObject=PdfParser.PdfDict(image=image_ref)),
+                MediaBox=[0, 0, width, height],
+                Contents=contents_ref,
+            )
+            pdf.write_obj(contents_ref, stream=b"q %d 0 0 %d 0 0 cm /image Do Q\n" % (width, height))
+
+        pdf.write_xref_and_trailer()
+        # Flush the finished PDF once, through the writer's own handle
+        pdf.f.flush()
+        os.fsync(pdf.f.fileno())
+
+
+def load_rgb(file):
+    with Image.open(file) as im:
+        return im.convert('RGB')
+
 
+def encode_page(file):
+    # Decode the page and recompress it the way Pillow's PDF driver would
+    with load_rgb(file) as image:
+        out = io.BytesIO()
+        image.save(out, format='JPEG')
+    return image.size, 'RGB', False, out.getbuffer()
 
-def build_pdf(jpg_list, output_path):
+
+def read_page(file):
+    try:
+        return read_jpeg(file)
+    except NotEmbeddable:
+        return encode_page(file)
+
+
+def publish(tmp_path, output_path):
+    os.replace(tmp_path, output_path)
+    # The PDF is in place now; persisting the rename is best-effort
+    if hasattr(os, 'O_DIRECTORY'):
+        try:
+            fd = os.open(os.path.dirname(output_path), os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
+
+
+def build_pdf(jpg_list, output_path, threads=1):
     tmp_path = output_path + ".chk"
     try:
-        images = []
-        for file in jpg_list:
-            with Image.open(file) as im:
-                images.append(im.convert('RGB'))
-        if images:
+        if jpg_list:
             os.makedirs(os.path.dirname(output_path), exist_ok=True)
-            images[0].save(tmp_path, save_all=True, append_images=images[1:], format="PDF")
-            os.rename(tmp_path, output_path)
+            embed_jpegs(jpg_list, tmp_path, threads)
+            publish(tmp_path, output_path)
             return True
     except Exception:
         if os.path.exists(tmp_path):
@@ -63,8 +225,8 @@ def build_pdf(jpg_list, output_path):
     return False
 
 
-def process_folder(args):
-    index, folder, total, output_dir = args
+def process_folder(task, output_dir, threads):
+    index, folder = task
     folder_name = os.path.basename(folder)
     yyyymm = extract_yyyymm(folder)
     if not yyyymm:
@@ -74,11 +236,11 @@ def process_folder(args):
     if has_pdf:
         return index, folder_name, "🟦 Existing"
 
-    jpgs = get_jpg_files(folder)
+    jpgs = get_jpg_files(folder, yyyymm)
     if not jpgs:
         return index, folder_name, "⏭️ Skipped"
 
-    success = build_pdf(jpgs, output_path)
+    success = build_pdf(jpgs, output_path, threads)
     return index, folder_name, "✅ Converted" if success else "❌ Failed"
 
 
@@ -86,15 +248,38 @@ def run_batch(root, output_dir, jobs):
     print(f"Scanning directory tree under '{root}'... please wait")
     start = time.time()
     folders = fast_find_dirs(root)
-    print(f"Found {len(folders)} folders in {time.time() - start:.2f} seconds.\n")
+    print(f"Found {len(folders)} folders with JPGs in {time.time() - start:.2f} seconds.")
+
+    # Drop finished issues here rather than paying a worker round trip for each
+    pending = []
+    for folder in folders:
+        output_path = output_pdf_path(folder, output_dir)
+        if not (output_path and os.path.exists(output_path)):
+            pending.append(folder)
+    print(f"Skipping {len(folders) - len(pending)} folders with an existing PDF.\n")
+    folders = pending
 
     total = len(folders)
-    args_list = [(i + 1, folder, total, output_dir) for i, folder in enumerate(folders)]
+    # Read-ahead threads per worker: they map the next scans and parse their JPEG
+    # headers while the current page is written, overlapping file reads with PDF
+    # writes. One is enough for that; spare cores with a low --jobs read further ahead
+    threads = max(1, cpu_count() // jobs)
+    # Settings shared by every folder are bound once instead of riding along in each task
+    worker = partial(process_folder, output_dir=output_dir, threads=threads)
 
+    # Hand out a few folders per round trip, but keep chunks small enough that
+    # one slow chunk of big issues does not leave the other workers idle at the end
+    chunksize = max(1, min(8, total // (jobs * 4)))
+
+    counts = Counter()
     with Pool(processes=jobs) as pool:
-        for index, foldername, status in pool.imap_unordered(process_folder, args_list):
+        for index, foldername, status in pool.imap_unordered(worker, enumerate(folders, 1), chunksize):
+            counts[status] += 1
             print(f"Processed {index}/{total} - [{foldername}] - Status: {status}")
 
+    if counts:
+        print("\nDone: " + ", ".join(f"{status} {count}" for status, count in counts.items()))
+
 
 def main():
     parser = argparse.ArgumentParser(description='Bind National Geographic JPG scans into a single PDF file.')